@@ -2,6 +2,9 @@ from dataclasses import dataclass
 from typing import Any, Self
 
 
+_missing = object()
+
+
 class Environment:
     def __init__(self, parent=None):
         self.parent = parent
@@ -9,19 +12,23 @@ class Environment:
         self.vars = {}
 
     def __contains__(self, name):
-        if name in self.vars:
-            return True
-        elif self.parent:
-            return name in self.parent
-        else:
-            return False
+        env = self
+        while env is not None:
+            if name in env.vars:
+                return True
+            env = env.parent
+
+        return False
 
     def __getitem__(self, name):
         env = self
-        while env.parent is not None and name not in env.vars:
+        while env is not None:
+            value = env.vars.get(name, _missing)
+            if value is not _missing:
+                return value
             env = env.parent
 
-        return env.vars[name]
+        raise KeyError(name)
 
     def __setitem__(self, name, value):
         env = self
@@ -55,3 +62,38 @@ class Environment:
             return str(self.parent) + str(self.vars)
         else:
             return str(self.vars)
+
+
+# frames are plain lists holding the parent frame followed by the values of the
+# slots the compiler assigned to its names. The frame of a struct expression has
+# a single slot for the struct under construction.
+FRAME_HEADER = 1
+
+
+def new_frame(parent=None, size=0):
+    return [parent, *[None] * size]
+
+
+class Struct:
+    def __init__(self, shape, parent=None, values=None):
+        # shape maps member names to slots and is shared by all structs built from one struct expression
+        self.shape = shape
+        self.parent = parent
+        self.values = values if values is not None else [None] * len(shape)
+
+    def __getitem__(self, name):
+        struct = self
+        while struct is not None:
+            slot = struct.shape.get(name)
+            if slot is not None:
+                return struct.values[slot]
+            struct = struct.parent
+
+        raise KeyError(name)
+
+    def __str__(self):
+        members = str(dict(zip(self.shape, self.values)))
+        if self.parent:
+            return str(self.parent) + members
+        else:
+            return members
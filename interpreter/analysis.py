@@ -0,0 +1,148 @@
+from dataclasses import fields
+
+from environment import Environment
+from syntaxtree.controlflow import LoopExpression, WhileExpression, DoWhileExpression, IfExpression
+from syntaxtree.literals import NumberLiteral, BoolLiteral, StringLiteral, CharLiteral, ArrayLiteral, DictLiteral
+from syntaxtree.functions import LambdaExpression, CallExpression
+from syntaxtree.operators import BinaryOperatorExpression, UnaryOperatorExpression
+from syntaxtree.sequences import SequenceExpression
+from syntaxtree.syntaxtree import Expression
+from syntaxtree.variables import AssignExpression, VariableExpression, LockExpression, LocalExpression
+
+
+def sub_expressions(expr):
+    for field in fields(expr):
+        value = getattr(expr, field.name)
+        if isinstance(value, Expression):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, Expression):
+                    yield item
+                elif isinstance(item, tuple):
+                    yield from (e for e in item if isinstance(e, Expression))
+
+
+def assigned_names(expr):
+    names = set()
+    if isinstance(expr, AssignExpression):
+        names.add(expr.var.name)
+    for sub_expr in sub_expressions(expr):
+        names |= assigned_names(sub_expr)
+    return names
+
+
+def referenced_names(expr):
+    if isinstance(expr, VariableExpression):
+        return {expr.name}
+    names = set()
+    for sub_expr in sub_expressions(expr):
+        names |= referenced_names(sub_expr)
+    return names
+
+
+def lookup(scope: Environment, name: str):
+    while scope is not None:
+        if name in scope.vars:
+            return scope, scope.vars[name]
+        scope = scope.parent
+    return None, None
+
+
+def is_pure(lmbd: LambdaExpression, scope: Environment):
+    """
+    A lambda is pure if its result only depends on its arguments: it reads and writes
+    nothing but its own bindings and only calls pure lambdas that are bound once by an
+    enclosing local, see mark_purity.
+    """
+    pure, callees = local_purity(lmbd, scope)
+    return pure and all(lookup(scope, name)[1].get('pure', False) for name in callees)
+
+
+def mark_purity(scope: Environment):
+    """
+    Marks the lambdas bound once by a local as pure or not. Lambdas that call each other
+    form strongly connected components, found with Tarjan's algorithm, and such a
+    component is pure as a whole if none of its lambdas does anything impure on its own
+    and every component they call is pure.
+    """
+    lambdas = {name: entry for name, entry in scope.vars.items() if entry.get('lambda') is not None}
+    local_pure, calls = {}, {}
+    for name, entry in lambdas.items():
+        local_pure[name], calls[name] = local_purity(entry['lambda'], scope)
+
+    index, low, stack, on_stack = {}, {}, [], set()
+
+    def connect(name):
+        index[name] = low[name] = len(index)
+        stack.append(name)
+        on_stack.add(name)
+        for callee in calls[name]:
+            if callee not in index:
+                connect(callee)
+                low[name] = min(low[name], low[callee])
+            elif callee in on_stack:
+                low[name] = min(low[name], index[callee])
+
+        if low[name] == index[name]:
+            component = set()
+            while name not in component:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.add(member)
+            # components are completed callees first, so those outside are marked already
+            pure = all(local_pure[member] and all(callee in component or lambdas[callee]['pure']
+                                                  for callee in calls[member])
+                       for member in component)
+            for member in component:
+                lambdas[member]['pure'] = pure
+
+    for name in lambdas:
+        if name not in index:
+            connect(name)
+
+
+def local_purity(lmbd: LambdaExpression, scope: Environment):
+    """
+    Returns whether the body of the lambda is pure assuming the lambdas it calls are,
+    along with the names of those callees whose purity is not known yet.
+    """
+    callees = set()
+
+    def pure_call(name):
+        entry = lookup(scope, name)[1]
+        if entry is None or entry.get('lambda') is None:
+            return False
+        if 'pure' in entry:
+            return entry['pure']
+        callees.add(name)
+        return True
+
+    def pure(expr, bound):
+        match expr:
+            case NumberLiteral() | BoolLiteral() | StringLiteral() | CharLiteral():
+                return True
+
+            case ArrayLiteral() | DictLiteral() | UnaryOperatorExpression() | BinaryOperatorExpression() \
+                 | SequenceExpression() | LockExpression() | LoopExpression() | WhileExpression() \
+                 | DoWhileExpression() | IfExpression():
+                return all(pure(sub_expr, bound) for sub_expr in sub_expressions(expr))
+
+            case VariableExpression(_, name):
+                # a lambda bound next to this one may not be assigned yet when it runs
+                return name in bound
+
+            case AssignExpression(_, var, expression):
+                return var.name in bound and pure(expression, bound)
+
+            case LocalExpression(_, assignments, body):
+                bound = bound | {assignment.var.name for assignment in assignments}
+                return all(pure(assignment, bound) for assignment in assignments) and pure(body, bound)
+
+            case CallExpression(_, VariableExpression(_, name), arg_exprs) if name not in bound:
+                return pure_call(name) and all(pure(arg_expr, bound) for arg_expr in arg_exprs)
+
+            case _:
+                return False
+
+    return pure(lmbd.body, set(lmbd.arg_names)), callees
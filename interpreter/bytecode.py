@@ -0,0 +1,573 @@
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from compiler.util import make_unique_label
+from environment import Environment, FRAME_HEADER
+from interpreter.analysis import assigned_names, referenced_names, is_pure, mark_purity
+from interpreter.jit import native_function
+from interpreter.operators import unary_operators, binary_operators
+from syntaxtree.controlflow import LoopExpression, WhileExpression, DoWhileExpression, IfExpression
+from syntaxtree.literals import NumberLiteral, BoolLiteral, StringLiteral, CharLiteral, ArrayLiteral, DictLiteral
+from syntaxtree.functions import LambdaExpression, CallExpression, ProcedureExpression
+from syntaxtree.module import ImportExpression
+from syntaxtree.operators import BinaryOperatorExpression, UnaryOperatorExpression
+from syntaxtree.sequences import SequenceExpression
+from syntaxtree.struct import StructExpression, MemberAccessExpression, MemberAssignExpression, ThisExpression
+from syntaxtree.syntaxtree import Expression, TrapExpression
+from syntaxtree.variables import AssignExpression, VariableExpression, LockExpression, LocalExpression
+
+
+# opcodes are numbered in blocks of 16 so run() can narrow down the
+# handler with a range check before comparing against single opcodes
+
+# stack and variable access
+LOAD_LOCAL = 0
+LOAD_CONST = 1
+LOAD_GLOBAL = 2
+LOAD_OUTER = 3
+STORE_LOCAL = 4
+STORE_GLOBAL = 5
+STORE_OUTER = 6
+POP = 7
+DUP = 8
+
+# control flow
+JMP_IF_FALSE = 16
+JMP = 17
+CALL = 18
+RETURN = 19
+LOOP_BACK = 20
+SETUP_LOOP = 21
+TRAP = 23
+CALL_CONST = 24
+
+# operators
+ADD = 32
+SUB = 33
+LE = 34
+MUL = 35
+GR = 36
+LEQ = 37
+GEQ = 38
+EQ = 39
+NEQ = 40
+DIV = 41
+INDEX = 42
+NEG = 43
+NOT = 44
+BINARY_OP = 45
+UNARY_OP = 46
+
+# closures, data structures and modules
+MEMBER = 48
+STORE_MEMBER = 49
+LOAD_THIS = 50
+MAKE_CLOSURE = 51
+MAKE_PROCEDURE = 52
+PUSH_FRAME = 53
+POP_FRAME = 54
+BUILD_ARRAY = 55
+BUILD_DICT = 56
+STRUCT_NEW = 57
+STRUCT_EXTEND = 58
+STRUCT_END = 59
+IMPORT = 60
+LET = 61
+
+# mnemonic -> (opcode, operand kind)
+opcodes = {
+    'loadc': (LOAD_CONST, 'const'),
+    'loadlocal': (LOAD_LOCAL, 'int'),
+    'storelocal': (STORE_LOCAL, 'int'),
+    'loadouter': (LOAD_OUTER, 'const'),
+    'storeouter': (STORE_OUTER, 'const'),
+    'loadglobal': (LOAD_GLOBAL, 'const'),
+    'storeglobal': (STORE_GLOBAL, 'const'),
+    'pop': (POP, None),
+    'dup': (DUP, None),
+    'jump': (JMP, 'label'),
+    'jumpz': (JMP_IF_FALSE, 'label'),
+    'setuploop': (SETUP_LOOP, 'label'),
+    'loopback': (LOOP_BACK, 'label'),
+    'call': (CALL, 'int'),
+    'callc': (CALL_CONST, 'const'),
+    'binop': (BINARY_OP, 'const'),
+    'unop': (UNARY_OP, 'const'),
+    'pushframe': (PUSH_FRAME, 'int'),
+    'let': (LET, 'int'),
+    'popframe': (POP_FRAME, None),
+    'mkclosure': (MAKE_CLOSURE, 'const'),
+    'mkproc': (MAKE_PROCEDURE, 'const'),
+    'mkarray': (BUILD_ARRAY, 'int'),
+    'mkdict': (BUILD_DICT, 'int'),
+    'newstruct': (STRUCT_NEW, 'const'),
+    'extendstruct': (STRUCT_EXTEND, 'const'),
+    'endstruct': (STRUCT_END, None),
+    'member': (MEMBER, 'const'),
+    'storemember': (STORE_MEMBER, 'const'),
+    'loadthis': (LOAD_THIS, 'int'),
+    'import': (IMPORT, 'const'),
+    'trap': (TRAP, None),
+    'ret': (RETURN, None),
+    'add': (ADD, None),
+    'sub': (SUB, None),
+    'mul': (MUL, None),
+    'div': (DIV, None),
+    'le': (LE, None),
+    'gr': (GR, None),
+    'leq': (LEQ, None),
+    'geq': (GEQ, None),
+    'eq': (EQ, None),
+    'neq': (NEQ, None),
+    'index': (INDEX, None),
+    'neg': (NEG, None),
+    'not': (NOT, None),
+}
+
+unop_inst = {
+    '-': ('neg',),
+    'NOT': ('not',),
+}
+binop_inst = {
+    '+': ('add',),
+    '-': ('sub',),
+    '*': ('mul',),
+    '/': ('div',),
+    '<': ('le',),
+    '>': ('gr',),
+    '<=': ('leq',),
+    '>=': ('geq',),
+    '==': ('eq',),
+    '!=': ('neq',),
+    'EQ': ('eq',),
+    'NEQ': ('neq',),
+    '[]': ('index',),
+}
+
+
+@dataclass
+class Code:
+    instructions: list[int]
+    consts: list[Any]
+    positions: list[tuple]
+    scopes: list[Environment]
+    # frame layout of function bodies: fixed arguments followed by the slots
+    # for the rest argument or procedure locals
+    arg_count: int = 0
+    local_slots: tuple = ()
+    # numba compiled equivalent of a numeric leaf lambda body
+    native: Any = None
+
+
+def push_scope(scope: Environment, names) -> Environment:
+    scope = Environment(scope)
+    scope.vars = {name: {'slot': slot} for slot, name in enumerate(names, FRAME_HEADER)}
+    return scope
+
+
+def resolve(scope: Environment, name: str):
+    depth = 0
+    while scope is not None:
+        if name in scope.vars:
+            return depth, scope.vars[name]['slot']
+        scope = scope.parent
+        depth += 1
+    return None
+
+
+def load(name: str, scope: Environment):
+    match resolve(scope, name):
+        case None:
+            return ('loadglobal', name)
+        case (0, slot):
+            return ('loadlocal', slot)
+        case (depth, slot):
+            return ('loadouter', (depth, slot))
+
+
+def store(name: str, scope: Environment):
+    match resolve(scope, name):
+        case None:
+            return ('storeglobal', name)
+        case (0, slot):
+            return ('storelocal', slot)
+        case (depth, slot):
+            return ('storeouter', (depth, slot))
+
+
+# literals are converted once per distinct value and shared by all code objects
+interned_literals = {}
+
+def struct_depth(scope: Environment):
+    # how many frames up the struct of the innermost struct expression lives
+    depth = 0
+    while scope is not None:
+        if scope.containing_struct is scope:
+            return depth
+        scope = scope.parent
+        depth += 1
+    return None
+
+
+def literal_value(expr: Expression):
+    match expr:
+        case NumberLiteral(_, value): value = float(value)
+        case BoolLiteral(_, value): return value == 'TRUE'
+        case StringLiteral(_, value): pass
+        case CharLiteral(_, value): pass
+    return interned_literals.setdefault(const_key(value), value)
+
+
+def scalar_key(value):
+    # repr keeps apart values that compare equal, like 0.0 and -0.0 or 1.0 and True
+    if type(value) in (float, bool, str, type(None)) or isinstance(value, np.generic):
+        return type(value), repr(value)
+    return None
+
+
+def const_key(value):
+    return scalar_key(value) or id(value)
+
+
+def is_literal(expr: Expression):
+    return type(expr) in (NumberLiteral, BoolLiteral, StringLiteral, CharLiteral)
+
+
+_not_constant = object()
+
+
+def constant_value(expr: Expression):
+    """
+    Evaluates operators on literal operands at compile time. Anything that would raise,
+    like a division by zero, is left for the interpreter to report at run time.
+    """
+    match expr:
+        case NumberLiteral() | BoolLiteral() | StringLiteral() | CharLiteral():
+            return literal_value(expr)
+
+        case ArrayLiteral(_, elements) if all(is_literal(elem) for elem in elements):
+            return np.array(tuple(literal_value(elem) for elem in elements))
+
+        case UnaryOperatorExpression(_, operator, operand):
+            value = constant_value(operand)
+            if value is _not_constant:
+                return _not_constant
+            try:
+                return unary_operators[operator](value)
+            except Exception:
+                return _not_constant
+
+        case BinaryOperatorExpression(_, operator, operands):
+            values = [constant_value(operand) for operand in operands]
+            if any(value is _not_constant for value in values):
+                return _not_constant
+            try:
+                return binary_operators[operator](*values)
+            except Exception:
+                return _not_constant
+
+        case _:
+            return _not_constant
+
+
+def folded(expr: Expression):
+    # only scalars are folded, arrays are built by their literal
+    value = constant_value(expr)
+    if type(value) in (float, bool, str) or isinstance(value, np.generic):
+        return interned_literals.setdefault(const_key(value), value)
+    return _not_constant
+
+
+def code(expr: Expression, scope: Environment):
+    match expr:
+        case NumberLiteral(pos, _) | BoolLiteral(pos, _) | StringLiteral(pos, _) | CharLiteral(pos, _):
+            return [('pos', pos), ('loadc', literal_value(expr))]
+
+        case ArrayLiteral(pos, elements) if all(is_literal(elem) for elem in elements):
+            # arrays are never modified in place, so every evaluation can share one
+            array = np.array(tuple(literal_value(elem) for elem in elements))
+            array.flags.writeable = False
+            return [('pos', pos), ('loadc', array)]
+
+        case ArrayLiteral(pos, elements):
+            return [
+                *[inst for elem in elements for inst in code(elem, scope)],
+                ('pos', pos),
+                ('mkarray', len(elements)),
+            ]
+
+        case DictLiteral(pos, elements):
+            return [
+                *[inst for key, value in elements for inst in [*code(key, scope), *code(value, scope)]],
+                ('pos', pos),
+                ('mkdict', len(elements)),
+            ]
+
+        case UnaryOperatorExpression(pos, _, _) | BinaryOperatorExpression(pos, _, _) \
+                if (value := folded(expr)) is not _not_constant:
+            return [('pos', pos), ('loadc', value)]
+
+        case UnaryOperatorExpression(pos, operator, operand):
+            return [
+                *code(operand, scope),
+                ('pos', pos),
+                unop_inst.get(operator, ('unop', unary_operators[operator])),
+            ]
+
+        case BinaryOperatorExpression(pos, operator, operands):
+            return [
+                *code(operands[0], scope),
+                *code(operands[1], scope),
+                ('pos', pos),
+                binop_inst.get(operator, ('binop', binary_operators[operator])),
+            ]
+
+        case AssignExpression(pos, var, expression):
+            return [
+                *code(expression, scope),
+                ('pos', pos),
+                ('dup',),
+                store(var.name, scope),
+            ]
+
+        case VariableExpression(pos, name):
+            return [('pos', pos), load(name, scope)]
+
+        case LockExpression(_, _, body):
+            return code(body, scope)
+
+        case LocalExpression(pos, assignments, body):
+            names = [assignment.var.name for assignment in assignments]
+            inner = push_scope(scope, names)
+
+            # bindings that are never reassigned keep their lambda for the purity analysis
+            reassigned = assigned_names(body) | {name for name in names if names.count(name) > 1}
+            for assignment in assignments:
+                reassigned |= assigned_names(assignment.expression)
+            for assignment in assignments:
+                if type(assignment.expression) == LambdaExpression and assignment.var.name not in reassigned:
+                    inner.vars[assignment.var.name]['lambda'] = assignment.expression
+            mark_purity(inner)
+
+            initializers = [assignment.expression for assignment in assignments]
+            if not any(referenced_names(initializer) & set(names) for initializer in initializers):
+                # no initializer sees the new bindings, so their values can be computed
+                # before the frame exists and become its slots right away
+                instructions = [inst for initializer in initializers for inst in code(initializer, scope)]
+                instructions += [('pos', pos), ('let', len(assignments)), ('scope', inner)]
+            else:
+                instructions = [('pos', pos), ('pushframe', len(assignments)), ('scope', inner)]
+                for assignment in assignments:
+                    instructions += discard(assignment, inner)
+
+            return [*instructions, *code(body, inner), ('popframe',), ('scope', scope)]
+
+        case SequenceExpression(pos, expressions):
+            if not expressions:
+                return [('pos', pos), ('loadc', None)]
+
+            instructions = []
+            for expression in expressions[:-1]:
+                instructions += discard(expression, scope)
+            return [*instructions, *code(expressions[-1], scope)]
+
+        case LoopExpression(pos, count, body):
+            loop_l, end_l = make_unique_label('loop', 'endloop')
+            return [
+                *code(count, scope),
+                ('pos', pos),
+                ('setuploop', end_l),
+                ('label', loop_l),
+                *code(body, scope),
+                ('loopback', loop_l),
+                ('label', end_l),
+            ]
+
+        case WhileExpression(pos, condition, body):
+            while_l, end_l = make_unique_label('while', 'endwhile')
+            return [
+                ('pos', pos),
+                ('loadc', None),
+                ('label', while_l),
+                *code(condition, scope),
+                ('jumpz', end_l),
+                ('pop',),
+                *code(body, scope),
+                ('jump', while_l),
+                ('label', end_l),
+            ]
+
+        case DoWhileExpression(pos, condition, body):
+            do_l, end_l = make_unique_label('do', 'enddo')
+            return [
+                ('label', do_l),
+                *code(body, scope),
+                *code(condition, scope),
+                ('jumpz', end_l),
+                ('pop',),
+                ('jump', do_l),
+                ('label', end_l),
+            ]
+
+        case IfExpression(pos, condition, then_body, else_body) if (value := folded(condition)) is not _not_constant:
+            if value:
+                return code(then_body, scope)
+            return code(else_body, scope) if else_body else [('pos', pos), ('loadc', None)]
+
+        case IfExpression(pos, condition, then_body, else_body):
+            else_l, endif_l = make_unique_label('else', 'endif')
+            return [
+                *code(condition, scope),
+                ('jumpz', else_l),
+                *code(then_body, scope),
+                ('jump', endif_l),
+                ('label', else_l),
+                *(code(else_body, scope) if else_body else [('pos', pos), ('loadc', None)]),
+                ('label', endif_l),
+            ]
+
+        case LambdaExpression(pos, arg_names, body, rest_args):
+            body_code = compile(body, push_scope(scope, arg_names))
+            body_code.arg_count = len(arg_names) - rest_args
+            body_code.local_slots = (None,) * rest_args
+            body_code.native = native_function(expr)
+            return [('pos', pos), ('mkclosure', (arg_names, body_code, rest_args, is_pure(expr, scope)))]
+
+        case ProcedureExpression(pos, arg_names, local_names, body):
+            body_code = compile(body, push_scope(None, [*arg_names, *local_names]))
+            body_code.arg_count = len(arg_names)
+            body_code.local_slots = (None,) * len(local_names)
+            return [('pos', pos), ('mkproc', (arg_names, body_code))]
+
+        case CallExpression(pos, f, arg_exprs):
+            arg_codes = [code(arg_expr, scope) for arg_expr in arg_exprs]
+            arg_insts = [[inst for inst in arg_code if inst[0] != 'pos'] for arg_code in arg_codes]
+            if all(len(insts) == 1 and insts[0][0] == 'loadc' for insts in arg_insts):
+                # all arguments are constants, the call passes them from one const tuple
+                return [*code(f, scope), ('pos', pos), ('callc', tuple(insts[0][1] for insts in arg_insts))]
+
+            return [
+                *code(f, scope),
+                *[inst for arg_code in arg_codes for inst in arg_code],
+                ('pos', pos),
+                ('call', len(arg_exprs)),
+            ]
+
+        case StructExpression(pos, initializers, parent_expr):
+            shape = {}
+            for init_expr in initializers:
+                shape.setdefault(init_expr.name, len(shape))
+            instructions = [*code(parent_expr, scope), ('pos', pos), ('extendstruct', shape)] if parent_expr else [('pos', pos), ('newstruct', shape)]
+
+            inner = push_scope(scope, [])
+            inner.containing_struct = inner
+            inner.shape = shape
+            instructions.append(('scope', inner))
+
+            for init_expr in initializers:
+                instructions += discard(init_expr, inner)
+
+            return [*instructions, ('endstruct',), ('scope', scope)]
+
+        case MemberAccessExpression(pos, expr, member, up_count):
+            return [
+                *code(expr, scope),
+                ('pos', pos),
+                ('member', (member, up_count, [None, None])),
+            ]
+
+        case MemberAssignExpression(pos, member, expr):
+            struct_scope = scope.containing_struct if scope else None
+            slot = struct_scope.shape.get(member) if struct_scope else None
+            if slot is None:
+                # unknown members fail before their value is evaluated
+                return [('pos', pos), ('storemember', (member, None, None))]
+
+            return [
+                *code(expr, scope),
+                ('pos', pos),
+                ('storemember', (member, struct_depth(scope), slot)),
+            ]
+
+        case ThisExpression(pos):
+            depth = struct_depth(scope)
+            return [('pos', pos), ('loadthis', depth) if depth is not None else ('loadc', None)]
+
+        case ImportExpression(pos, path):
+            return [('pos', pos), ('import', path)]
+
+        case TrapExpression(pos):
+            return [('pos', pos), ('trap',)]
+
+        case _:
+            raise NotImplementedError(expr)
+
+
+def discard(expr: Expression, scope: Environment):
+    match expr:
+        case AssignExpression(pos, var, expression):
+            return [
+                *code(expression, scope),
+                ('pos', pos),
+                store(var.name, scope),
+            ]
+
+        case _:
+            return [*code(expr, scope), ('pop',)]
+
+
+def assemble(ir) -> Code:
+    labels = {}
+    address = 0
+    for inst in ir:
+        match inst:
+            case ('label', name):
+                labels[name] = address
+            case ('pos' | 'scope', _):
+                pass
+            case _:
+                address += 2
+
+    instructions = []
+    consts = []
+    const_slots = {}
+    positions = []
+    scopes = []
+    pos = None
+    scope = None
+    for inst in ir:
+        match inst:
+            case ('label', _):
+                continue
+            case ('pos', p):
+                pos = p
+                continue
+            case ('scope', s):
+                scope = s
+                continue
+            case (mnemonic, *args):
+                op, kind = opcodes[mnemonic]
+
+        match kind:
+            case 'const':
+                arg = const_slots.setdefault(const_key(args[0]), len(consts))
+                if arg == len(consts):
+                    consts.append(args[0])
+            case 'label':
+                arg = labels[args[0]]
+            case 'int':
+                arg = args[0]
+            case None:
+                arg = 0
+
+        instructions += [op, arg]
+        positions.append(pos)
+        scopes.append(scope)
+
+    return Code(instructions, consts, positions, scopes)
+
+
+def compile(expr: Expression, scope: Environment = None) -> Code:
+    return assemble([('scope', scope), *code(expr, scope), ('ret',)])
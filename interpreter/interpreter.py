@@ -1,47 +1,58 @@
-from dataclasses import dataclass
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import repeat
 
 import numpy as np
 
 from lexer.lexer import make_incc24_lexer
 
-from environment import Environment
+from environment import Environment, Struct, new_frame, FRAME_HEADER
+from interpreter.bytecode import *
+from interpreter.jit import NumbaError, argument_signature
 from parser.parser import parse_expr, parse_file
-from syntaxtree.controlflow import LoopExpression, WhileExpression, DoWhileExpression, IfExpression
-from syntaxtree.literals import NumberLiteral, BoolLiteral, StringLiteral, CharLiteral, ArrayLiteral, DictLiteral
-from syntaxtree.functions import LambdaExpression, CallExpression, ProcedureExpression
-from syntaxtree.module import ImportExpression
-from syntaxtree.operators import BinaryOperatorExpression, UnaryOperatorExpression
-from syntaxtree.sequences import SequenceExpression
-from syntaxtree.struct import StructExpression, MemberAccessExpression, MemberAssignExpression, ThisExpression
 
-from syntaxtree.syntaxtree import Expression, TrapExpression
-from syntaxtree.variables import AssignExpression, VariableExpression, LockExpression, LocalExpression
 
+# syntax trees are never modified after parsing, so identical sources can share one
+cached_parse_expr = lru_cache(maxsize=1024)(parse_expr)
 
-@dataclass
+
+# compiled code holds no per-run state, so a module imported again runs its
+# existing code instead of walking the syntax tree once more
+@lru_cache(maxsize=128)
+def _cached_compile_file(path, mtime):
+    return compile(parse_file(path))
+
+
+def cached_compile_file(path):
+    return _cached_compile_file(path, os.stat(path).st_mtime_ns)
+
+
+_not_cached = object()
+
+
+@dataclass(eq=False)
 class Closure:
-    parent_env: Environment
+    parent_frame: list
+    globals: Environment
     arg_names: list[str]
-    body: Expression
+    code: Code
     rest_args: bool
-    local_names: list[str] = None
 
     def __call__(self, *arg_values):
-        if self.local_names is None:
-            env = self.parent_env.push(*self.arg_names)
+        code = self.code
+        n = code.arg_count
+
+        if len(arg_values) == n:
+            frame = [self.parent_frame, *arg_values, *code.local_slots]
         else:
-            env = self.parent_env.push(*self.arg_names, *self.local_names)
+            frame = [self.parent_frame, *arg_values[:n], *[None] * (n - len(arg_values)), *code.local_slots]
 
         if self.rest_args:
-            for i in range(len(self.arg_names) - 1):
-                env[self.arg_names[i]] = arg_values[i]
-
-            env[self.arg_names[-1]] = np.array(arg_values[len(self.arg_names) - 1:])
-        else:
-            for arg_name, arg_value in zip(self.arg_names, arg_values):
-                env[arg_name] = arg_value
+            frame[FRAME_HEADER + n] = np.asarray(arg_values[n:])
 
-        return eval(self.body, env)
+        return run(code, frame, self.globals)
 
     def __str__(self):
         return f'fun(' + ', '.join(map(str, self.arg_names)) + ('...' if self.rest_args else '') + ')'
@@ -50,167 +61,312 @@ class Closure:
         return str(self)
 
 
-def eval(expr: Expression, env: Environment):
+# results a pure closure remembers before it drops the least recently used one
+memo_size = 4096
+
+
+def memo_key(value):
+    if type(value) is tuple:
+        # lists are compared element by element, which would mix up 1.0 and TRUE in them
+        raise TypeError('lists are not memoized')
+    return scalar_key(value) or (type(value), value)
+
+
+@dataclass(repr=False, eq=False)
+class PureClosure(Closure):
+    cache: OrderedDict = field(default_factory=OrderedDict)
+
+    def __call__(self, *arg_values):
+        cache = self.cache
+        try:
+            key = tuple(map(memo_key, arg_values))
+            result = cache.get(key, _not_cached)
+        except TypeError:
+            # unhashable arguments like arrays are never cached
+            return super().__call__(*arg_values)
+
+        if result is _not_cached:
+            result = cache[key] = super().__call__(*arg_values)
+            if len(cache) > memo_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return result
+
+
+@dataclass(repr=False, eq=False)
+class NativeClosure(Closure):
+    def __call__(self, *arg_values):
+        native = self.code.native
+        if native.available and len(arg_values) == self.code.arg_count and not dbg.stepping:
+            signature = argument_signature(arg_values)
+            if signature not in native.unsupported:
+                try:
+                    return native(*arg_values)
+                except NumbaError:
+                    # argument types numba cannot compile for, like strings or dicts
+                    native.unsupported.add(signature)
+                except OSError:
+                    # the module could not be written to the cache directory, like one under /proc
+                    native.available = False
+        return super().__call__(*arg_values)
+
+
+def run(code: Code, frame: list, globals: Environment):
+    # frame[0] is the parent frame, see new_frame
     global dbg
-    if dbg.should_stop(expr, env):
-        dbg.debugger_stop(expr, env)
-
-    match expr:
-        case NumberLiteral(_, value): return float(value)
-        case BoolLiteral(_, value): return value == 'TRUE'
-        case StringLiteral(_, value): return value
-        case CharLiteral(_, value): return value
-        case ArrayLiteral(_, elements): return make_array(*[eval(elem, env) for elem in elements])
-        case DictLiteral(_, elements): return {eval(key, env) : eval(value, env) for key, value in elements}
-
-        case UnaryOperatorExpression(_, operator, operand):
-            val = eval(operand, env)
-
-            match operator:
-                case '+': return +val
-                case '-' : return -val
-                case 'NOT': return not val
-
-        case BinaryOperatorExpression(_, operator, operands):
-            val0 = eval(operands[0], env)
-            val1 = eval(operands[1], env)
-
-            match operator:
-                case '+': return val0 + val1
-                case '-': return val0 - val1
-                case '*': return val0 * val1
-                case '/': return val0 / val1
-                case '<': return val0 < val1
-                case '>': return val0 > val1
-                case '<=': return val0 <= val1
-                case '>=': return val0 >= val1
-                case '==': return val0 == val1
-                case '!=': return val0 != val1
-                case 'EQ': return val0 == val1
-                case 'NEQ': return val0 != val1
-                case 'XOR': return val0 != val1
-                case 'AND': return val0 and val1
-                case 'OR': return val0 or val1
-                case 'NAND': return not (val0 and val1)
-                case 'NOR': return not (val0 or val1)
-                case 'IMP': return not val0 or val1
-                case '[]':
-                    if type(val0) != dict:
-                        val1 = int(val1)
-                    return val0[val1]
-
-        case AssignExpression(_, var, expression):
-            res = eval(expression, env)
-            env[var.name] = res
-            return res
-
-        case VariableExpression(pos, name):
-            if name not in env:
-                raise KeyError(f"Unknown variable {name} in {pos[0]}:{pos[1]}")
-
-            return env[name]
-
-        case LockExpression(_, _, body):
-            return eval(body, env)
-
-        case LocalExpression(_, assignments, body):
-            env = env.push(*[assignment.var.name for assignment in assignments])
-
-            for assignment in assignments:
-                eval(assignment, env)
-
-            return eval(body, env)
-
-        case SequenceExpression(_, expressions):
-            result = None
-            for expression in expressions:
-                result = eval(expression, env)
-            return result
-
-        case LoopExpression(_, count, body):
-            n = int(eval(count, env))
-
-            result = None
-            for _ in range(n):
-                result = eval(body, env)
-            return result
-
-        case WhileExpression(_, condition, body):
-            result = None
-            while eval(condition, env):
-                result = eval(body, env)
-            return result
-
-        case DoWhileExpression(_, condition, body):
-            result = eval(body, env)
-            while eval(condition, env):
-                result = eval(body, env)
-            return result
-
-        case IfExpression(_, condition, then_body, else_body):
-            if eval(condition, env):
-                return eval(then_body, env)
-            elif else_body:
-                return eval(else_body, env)
-            else:
-                return None
+    instructions = code.instructions
+    consts = code.consts
+    stack = []
+    pc = 0
+    stepping = dbg.stepping
+
+    while True:
+        if stepping and dbg.should_stop(code, pc):
+            dbg.debugger_stop(code, pc, frame, globals)
+            stepping = dbg.stepping
+
+        op = instructions[pc]
+        arg = instructions[pc + 1]
+        pc += 2
+
+        if op < 16:
+            if op == LOAD_LOCAL:
+                stack.append(frame[arg])
+
+            elif op == LOAD_CONST:
+                stack.append(consts[arg])
+
+            elif op == LOAD_GLOBAL:
+                try:
+                    stack.append(globals[consts[arg]])
+                except KeyError:
+                    pos = code.positions[pc // 2 - 1]
+                    raise KeyError(f"Unknown variable {consts[arg]} in {pos[0]}:{pos[1]}") from None
+
+            elif op == LOAD_OUTER:
+                depth, slot = consts[arg]
+                f = frame
+                for _ in range(depth):
+                    f = f[0]
+                stack.append(f[slot])
+
+            elif op == STORE_LOCAL:
+                frame[arg] = stack.pop()
+
+            elif op == STORE_GLOBAL:
+                globals[consts[arg]] = stack.pop()
+
+            elif op == STORE_OUTER:
+                depth, slot = consts[arg]
+                f = frame
+                for _ in range(depth):
+                    f = f[0]
+                f[slot] = stack.pop()
+
+            elif op == POP:
+                stack.pop()
+
+            elif op == DUP:
+                stack.append(stack[-1])
 
-        case LambdaExpression(_, arg_names, body, rest_args):
-            return Closure(env, arg_names, body, rest_args)
+            else:
+                raise NotImplementedError(op)
+
+        elif op < 32:
+            if op == JMP_IF_FALSE:
+                if not stack.pop():
+                    pc = arg
+
+            elif op == JMP:
+                pc = arg
+
+            elif op == CALL:
+                n = len(stack) - arg
+                arg_values = stack[n:]
+                del stack[n:]
+                stack[-1] = stack[-1](*arg_values)
+                stepping = dbg.stepping
+
+            elif op == CALL_CONST:
+                stack[-1] = stack[-1](*consts[arg])
+                stepping = dbg.stepping
+
+            elif op == RETURN:
+                return stack.pop()
+
+            elif op == LOOP_BACK:
+                stack[-2] = stack.pop()
+                if next(stack[-1], False):
+                    pc = arg
+                else:
+                    stack.pop()
 
-        case ProcedureExpression(_, arg_names, local_names, body):
-            return Closure(define_built_ins(env.root().push()), arg_names, body, False, local_names)
+            elif op == SETUP_LOOP:
+                counter = repeat(True, int(stack[-1]))
+                stack[-1] = None
+                if next(counter, False):
+                    stack.append(counter)
+                else:
+                    pc = arg
 
-        case CallExpression(_, f, arg_exprs):
-            callable = eval(f, env)
-            arg_values = [eval(arg_expr, env) for arg_expr in arg_exprs]
-            return callable(*arg_values)
+            elif op == TRAP:
+                if not dbg.stopped:
+                    dbg.debugger_stop(code, pc - 2, frame, globals)
+                    stepping = dbg.stepping
+                stack.append(None)
 
-        case StructExpression(_, initializers, parent_expr):
-            if parent_expr:
-                struct = eval(parent_expr, env).push()
             else:
-                struct = Environment()
+                raise NotImplementedError(op)
+
+        elif op < 48:
+            if op == ADD:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] + val1
 
-            struct.vars = {init_expr.name: None for init_expr in initializers}
-            env = env.push()
-            env.containing_struct = struct
+            elif op == SUB:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] - val1
 
-            for init_expr in initializers:
-                eval(init_expr, env)
+            elif op == LE:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] < val1
 
-            return struct
+            elif op == MUL:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] * val1
 
-        case MemberAccessExpression(pos, expr, member, up_count):
-            struct = eval(expr, env)
+            elif op == GR:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] > val1
 
-            for _ in range(up_count):
-                struct = struct.parent
+            elif op == LEQ:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] <= val1
 
-            if member not in struct:
-                raise KeyError(f'Unknown member {member} in {pos[0]}:{pos[1]}')
+            elif op == GEQ:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] >= val1
 
-            return struct[member]
+            elif op == EQ:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] == val1
 
-        case MemberAssignExpression(pos, member, expr):
-            if not env.containing_struct or member not in env.containing_struct.vars:
-                raise KeyError(f'Unknown member {member} in {pos[0]}:{pos[1]}')
+            elif op == NEQ:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] != val1
 
-            val = eval(expr, env)
-            env.containing_struct.vars[member] = val
-            return val
+            elif op == DIV:
+                val1 = stack.pop()
+                stack[-1] = stack[-1] / val1
 
-        case ThisExpression(_):
-            return env.containing_struct
+            elif op == INDEX:
+                val1 = stack.pop()
+                if type(stack[-1]) != dict:
+                    val1 = int(val1)
+                stack[-1] = stack[-1][val1]
 
-        case ImportExpression(_, path):
-            return eval(parse_file(path), define_built_ins(Environment()))
+            elif op == NEG:
+                stack[-1] = -stack[-1]
 
-        case TrapExpression(_):
-            return None
+            elif op == NOT:
+                stack[-1] = not stack[-1]
 
-        case _:
-            raise NotImplementedError(expr)
+            elif op == BINARY_OP:
+                val1 = stack.pop()
+                stack[-1] = consts[arg](stack[-1], val1)
+
+            elif op == UNARY_OP:
+                stack[-1] = consts[arg](stack[-1])
+
+            else:
+                raise NotImplementedError(op)
+
+        else:
+            if op == MEMBER:
+                member, up_count, cache = consts[arg]
+                struct = stack[-1]
+
+                for _ in range(up_count):
+                    struct = struct.parent
+
+                if struct.shape is cache[0]:
+                    stack[-1] = struct.values[cache[1]]
+                else:
+                    slot = struct.shape.get(member)
+                    if slot is not None:
+                        # remember where the member lives for the next struct of this shape
+                        cache[0], cache[1] = struct.shape, slot
+                        stack[-1] = struct.values[slot]
+                    else:
+                        try:
+                            stack[-1] = struct[member]
+                        except KeyError:
+                            pos = code.positions[pc // 2 - 1]
+                            raise KeyError(f'Unknown member {member} in {pos[0]}:{pos[1]}') from None
+
+            elif op == STORE_MEMBER:
+                member, depth, slot = consts[arg]
+                if slot is None:
+                    pos = code.positions[pc // 2 - 1]
+                    raise KeyError(f'Unknown member {member} in {pos[0]}:{pos[1]}')
+
+                f = frame
+                for _ in range(depth):
+                    f = f[0]
+                f[1].values[slot] = stack[-1]
+
+            elif op == LOAD_THIS:
+                f = frame
+                for _ in range(arg):
+                    f = f[0]
+                stack.append(f[1])
+
+            elif op == MAKE_CLOSURE:
+                arg_names, body, rest_args, pure = consts[arg]
+                closure_type = NativeClosure if body.native else PureClosure if pure else Closure
+                stack.append(closure_type(frame, globals, arg_names, body, rest_args))
+
+            elif op == MAKE_PROCEDURE:
+                arg_names, body = consts[arg]
+                stack.append(Closure(new_frame(), define_built_ins(globals.root().push()), arg_names, body, False))
+
+            elif op == PUSH_FRAME:
+                frame = [frame, *[None] * arg]
+
+            elif op == POP_FRAME:
+                frame = frame[0]
+
+            elif op == LET:
+                n = len(stack) - arg
+                frame = [frame, *stack[n:]]
+                del stack[n:]
+
+            elif op == BUILD_ARRAY:
+                n = len(stack) - arg
+                elements = stack[n:]
+                del stack[n:]
+                stack.append(make_array(*elements))
+
+            elif op == BUILD_DICT:
+                n = len(stack) - 2 * arg
+                elements = stack[n:]
+                del stack[n:]
+                stack.append(dict(zip(elements[::2], elements[1::2])))
+
+            elif op == STRUCT_NEW or op == STRUCT_EXTEND:
+                struct = Struct(consts[arg], stack.pop() if op == STRUCT_EXTEND else None)
+                frame = [frame, struct]
+                stack.append(struct)
+
+            elif op == STRUCT_END:
+                frame = frame[0]
+
+            elif op == IMPORT:
+                stack.append(run(cached_compile_file(consts[arg]), new_frame(), define_built_ins(Environment())))
+
+            else:
+                raise NotImplementedError(op)
 
 
 class Debugger:
@@ -218,19 +374,22 @@ class Debugger:
         self.stepping = False
         self.stopped = False
         self.watching = {}
+        self.position = None
 
-    def should_stop(self, expr, env):
-        return not self.stopped and (type(expr) == TrapExpression or self.stepping)
+    def should_stop(self, code, pc):
+        return not self.stopped and self.stepping and code.positions[pc // 2] is not self.position
 
-    def debugger_stop(self, expr, env):
+    def debugger_stop(self, code, pc, frame, globals):
         self.stepping = True
         self.stopped = True
+        self.position = code.positions[pc // 2]
+        scope = code.scopes[pc // 2]
 
         while True:
             for text, e in self.watching.items():
-                print(text, '=', eval(e, env))
+                print(text, '=', run(compile(e, scope), frame, globals))
 
-            match input(f'{expr.position[0]} line {expr.position[1]}> ').split(' '):
+            match input(f'{self.position[0]} line {self.position[1]}> ').split(' '):
                 case ['s']:
                     break
                 case ['c']:
@@ -238,16 +397,21 @@ class Debugger:
                     break
                 case ['v' | 'var' | 'vars']:
                     print('========== VAR DUMP ==========')
-                    e = env
+                    s, f = scope, frame
+                    while s is not None:
+                        for name, entry in s.vars.items():
+                            print(f'{name:<24} = {f[entry["slot"]]}')
+                        s, f = s.parent, f[0]
+                    e = globals
                     while e is not None:
                         for name, value in e.vars.items():
                             print(f'{name:<24} = {value}')
                         e = e.parent
                 case ['w', *text]:
                     text = ' '.join(text)
-                    self.watching[text] = parse_expr(text)
+                    self.watching[text] = cached_parse_expr(text)
                 case ['$' | 'e' | 'eval', *text]:
-                    print(eval(parse_expr(' '.join(text)), env))
+                    print(run(compile(cached_parse_expr(' '.join(text)), scope), frame, globals))
 
         self.stopped = False
 
@@ -257,9 +421,10 @@ def cons(a, b):
 
 
 def make_list(*elem):
-    if len(elem) == 0:
-        return ()
-    return cons(elem[0], make_list(*elem[1:]))
+    l = ()
+    for e in reversed(elem):
+        l = cons(e, l)
+    return l
 
 
 def head(l):
@@ -292,9 +457,11 @@ def define(env, name, val):
     env.vars[name] = val
 
 
-def wrap_lexer(lexer):
-    lexer_struct = Environment()
+token_shape = {'type': 0, 'value': 1, 'lineno': 2, 'lexpos': 3}
+lexer_shape = {'input': 0, 'next': 1, 'has_next': 2}
+
 
+def wrap_lexer(lexer):
     def lexer_input(s):
         lexer.input(s)
 
@@ -313,18 +480,9 @@ def wrap_lexer(lexer):
         if t is None:
             return ()
 
-        token_struct = Environment()
-        define(token_struct, 'type', t.type)
-        define(token_struct, 'value', t.value)
-        define(token_struct, 'lineno', t.lineno)
-        define(token_struct, 'lexpos', t.lexpos)
-        return token_struct
-
-    define(lexer_struct, 'input', lexer_input)
-    define(lexer_struct, 'next', lexer_next)
-    define(lexer_struct, 'has_next', lexer_has_next)
+        return Struct(token_shape, values=[t.type, t.value, t.lineno, t.lexpos])
 
-    return lexer_struct
+    return Struct(lexer_shape, values=[lexer_input, lexer_next, lexer_has_next])
 
 
 def define_built_ins(env):
@@ -351,19 +509,19 @@ def main(args):
     global dbg
     global_vars = Environment()
     env = define_built_ins(global_vars.push())
+    frame = new_frame()
 
     dbg = Debugger()
     if args.file:
-        expr = parse_file(args.file)
-        res = eval(expr, env)
+        res = run(cached_compile_file(args.file), frame, env)
         print(res)
 
     if args.repl:
         while True:
             try:
                 inp = input("> ")
-                expr = parse_expr(inp)
-                res = eval(expr, env)
+                expr = cached_parse_expr(inp)
+                res = run(compile(expr), frame, env)
                 print(res)
             except (EOFError, KeyboardInterrupt):
                 break
@@ -0,0 +1,345 @@
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+
+try:
+    import numba
+    from numba.core.errors import NumbaError
+except ImportError:
+    numba = None
+    NumbaError = ()
+
+from syntaxtree.controlflow import LoopExpression, WhileExpression, DoWhileExpression, IfExpression
+from syntaxtree.literals import NumberLiteral, BoolLiteral
+from syntaxtree.functions import LambdaExpression
+from syntaxtree.operators import BinaryOperatorExpression, UnaryOperatorExpression
+from syntaxtree.sequences import SequenceExpression
+from syntaxtree.variables import AssignExpression, VariableExpression, LockExpression, LocalExpression
+
+
+cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'incc24', 'jit')
+
+# without bounds checks numba would read past the end of an array instead of raising
+jit_options = {'cache': True, 'boundscheck': True}
+
+unary_templates = {
+    '+': '(+{0})',
+    '-': '(-{0})',
+    'NOT': '(not {0})',
+}
+
+binary_templates = {
+    '+': '({0} + {1})',
+    '-': '({0} - {1})',
+    '*': '({0} * {1})',
+    '/': '({0} / {1})',
+    '<': '({0} < {1})',
+    '>': '({0} > {1})',
+    '<=': '({0} <= {1})',
+    '>=': '({0} >= {1})',
+    '==': '({0} == {1})',
+    '!=': '({0} != {1})',
+    'EQ': '({0} == {1})',
+    'NEQ': '({0} != {1})',
+    'XOR': '({0} != {1})',
+    'AND': '({0} and {1})',
+    'OR': '({0} or {1})',
+    'NAND': '(not ({0} and {1}))',
+    'NOR': '(not ({0} or {1}))',
+    'IMP': '(not {0} or {1})',
+    '[]': '{0}[int({1})]',
+}
+
+# operators whose result is a boolean whatever their operands are
+bool_operators = {'<', '>', '<=', '>=', '==', '!=', 'EQ', 'NEQ', 'XOR', 'NAND', 'NOR'}
+
+
+class NotNumeric(Exception):
+    pass
+
+
+class NativeFunction:
+    """
+    Numba compiled equivalent of a numeric leaf lambda. The generated module is
+    written to the cache directory so numba can keep its machine code on disk.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.function = None
+        # cleared when the cache directory cannot be written, the lambda then stays on the bytecode path
+        self.available = True
+        # signatures of arguments numba failed to compile for, see argument_signature
+        self.unsupported = set()
+
+    def __call__(self, *arg_values):
+        if self.function is None:
+            self.function = load(self.source)
+        return self.function(*arg_values)
+
+
+def argument_signature(arg_values):
+    # numba compiles one specialization per argument types, and for arrays per dtype and dimension
+    return tuple((type(value), getattr(value, 'dtype', None), getattr(value, 'ndim', None)) for value in arg_values)
+
+
+def load(source: str):
+    # the cache directory is private to the user and a cached module is only
+    # imported if it holds exactly the source generated for this lambda
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+
+    name = 'f' + hashlib.sha1(source.encode()).hexdigest()
+    path = os.path.join(cache_dir, name + '.py')
+    try:
+        with open(path) as file:
+            cached = file.read()
+    except FileNotFoundError:
+        cached = None
+
+    if cached != source:
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        with os.fdopen(fd, 'w') as file:
+            file.write(source)
+        os.replace(temp_path, path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # numba looks the module up by name when it loads machine code from its cache
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return numba.njit(**jit_options)(module.f)
+
+
+def contains_loop(expr):
+    match expr:
+        case LoopExpression() | WhileExpression() | DoWhileExpression():
+            return True
+        case UnaryOperatorExpression(_, _, operand):
+            return contains_loop(operand)
+        case BinaryOperatorExpression(_, _, operands):
+            return any(contains_loop(operand) for operand in operands)
+        case SequenceExpression(_, expressions):
+            return any(contains_loop(e) for e in expressions)
+        case IfExpression(_, condition, then_body, else_body):
+            return any(contains_loop(e) for e in (condition, then_body, else_body) if e is not None)
+        case AssignExpression(_, _, expression):
+            return contains_loop(expression)
+        case LockExpression(_, _, body):
+            return contains_loop(body)
+        case LocalExpression(_, assignments, body):
+            return any(contains_loop(a.expression) for a in assignments) or contains_loop(body)
+        case _:
+            return False
+
+
+def is_simple(expr):
+    """Simple expressions translate to a single Python expression without statements."""
+    match expr:
+        case NumberLiteral() | BoolLiteral() | VariableExpression():
+            return True
+        case UnaryOperatorExpression(_, _, operand):
+            return is_simple(operand)
+        case BinaryOperatorExpression(_, _, operands):
+            return all(is_simple(operand) for operand in operands)
+        case IfExpression(_, condition, then_body, else_body):
+            return else_body is not None and is_simple(condition) and is_simple(then_body) and is_simple(else_body)
+        case _:
+            return False
+
+
+def unify(kind0, kind1):
+    """
+    Numba gives a variable a single type and would turn TRUE into 1.0 when it also
+    holds numbers, so booleans must not mix with other values. None stands for a
+    value of unknown type, like an argument or an array element.
+    """
+    if kind0 == kind1:
+        return kind0
+    if 'bool' in (kind0, kind1):
+        raise NotNumeric()
+    return None
+
+
+class SourceGen:
+    def __init__(self):
+        self.lines = []
+        self.counter = 0
+        # kinds of the values held by the generated variables, see unify
+        self.kinds = {}
+
+    def fresh(self):
+        self.counter += 1
+        return f'v{self.counter}'
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def temp(self, value, depth):
+        name = self.fresh()
+        self.emit(depth, f'{name} = {value}')
+        return name
+
+    def store(self, name, kind):
+        self.kinds[name] = unify(self.kinds[name], kind) if name in self.kinds else kind
+
+    def value(self, expr, names, depth):
+        """Returns the Python expression for the value of expr and its kind."""
+        match expr:
+            case NumberLiteral(_, value):
+                return repr(float(value)), 'number'
+
+            case BoolLiteral(_, value):
+                return repr(value == 'TRUE'), 'bool'
+
+            case VariableExpression(_, name) if name in names:
+                return names[name], self.kinds.get(names[name])
+
+            case UnaryOperatorExpression(_, operator, operand) if operator in unary_templates:
+                operand_value, _ = self.value(operand, names, depth)
+                return unary_templates[operator].format(operand_value), 'bool' if operator == 'NOT' else 'number'
+
+            case BinaryOperatorExpression(_, operator, (left, right)) if operator in binary_templates:
+                left_value, left_kind = self.value(left, names, depth)
+                if not is_simple(right):
+                    # the statements for the right operand may reassign what the left one reads
+                    left_value = self.temp(left_value, depth)
+                right_value, right_kind = self.value(right, names, depth)
+                if operator in ('AND', 'OR', 'NAND', 'NOR', 'IMP'):
+                    # the interpreter evaluates both operands, Python would short-circuit
+                    left_value, right_value = self.temp(left_value, depth), self.temp(right_value, depth)
+                if operator in bool_operators:
+                    kind = 'bool'
+                elif operator in ('AND', 'OR'):
+                    kind = unify(left_kind, right_kind)
+                elif operator == 'IMP':
+                    kind = unify('bool', right_kind)
+                elif operator == '[]':
+                    kind = None
+                else:
+                    kind = 'number'
+                return binary_templates[operator].format(left_value, right_value), kind
+
+            case IfExpression(_, condition, then_body, else_body) if else_body is not None:
+                if is_simple(expr):
+                    (condition_value, _), (then_value, then_kind), (else_value, else_kind) = (
+                        self.value(e, names, depth) for e in (condition, then_body, else_body))
+                    return f'({then_value} if {condition_value} else {else_value})', unify(then_kind, else_kind)
+                result = self.fresh()
+                self.emit(depth, f'if {self.value(condition, names, depth)[0]}:')
+                then_value, then_kind = self.value(then_body, names, depth + 1)
+                self.emit(depth + 1, f'{result} = {then_value}')
+                self.emit(depth, 'else:')
+                else_value, else_kind = self.value(else_body, names, depth + 1)
+                self.emit(depth + 1, f'{result} = {else_value}')
+                self.store(result, unify(then_kind, else_kind))
+                return result, self.kinds[result]
+
+            case SequenceExpression(_, expressions):
+                for e in expressions[:-1]:
+                    self.discard(e, names, depth)
+                return self.value(expressions[-1], names, depth)
+
+            case AssignExpression(_, VariableExpression(_, name), expression) if name in names:
+                value, kind = self.value(expression, names, depth)
+                self.emit(depth, f'{names[name]} = {value}')
+                self.store(names[name], kind)
+                return names[name], self.kinds[names[name]]
+
+            case LockExpression(_, _, body):
+                return self.value(body, names, depth)
+
+            case LocalExpression(_, assignments, body):
+                names = names | {assignment.var.name: self.fresh() for assignment in assignments}
+                for assignment in assignments:
+                    self.discard(assignment, names, depth)
+                return self.value(body, names, depth)
+
+            case _:
+                # loops and one-armed ifs may produce None, everything else is not numeric
+                raise NotNumeric()
+
+    def discard(self, expr, names, depth):
+        match expr:
+            case LoopExpression(_, count, body):
+                self.emit(depth, f'for _ in range(int({self.value(count, names, depth)[0]})):')
+                self.block(body, names, depth + 1)
+
+            case WhileExpression(_, condition, body):
+                if is_simple(condition):
+                    self.emit(depth, f'while {self.value(condition, names, depth)[0]}:')
+                else:
+                    self.emit(depth, 'while True:')
+                    self.emit(depth + 1, f'if not {self.value(condition, names, depth + 1)[0]}:')
+                    self.emit(depth + 2, 'break')
+                self.block(body, names, depth + 1)
+
+            case DoWhileExpression(_, condition, body):
+                self.emit(depth, 'while True:')
+                self.discard(body, names, depth + 1)
+                self.emit(depth + 1, f'if not {self.value(condition, names, depth + 1)[0]}:')
+                self.emit(depth + 2, 'break')
+
+            case IfExpression(_, condition, then_body, else_body):
+                self.emit(depth, f'if {self.value(condition, names, depth)[0]}:')
+                self.block(then_body, names, depth + 1)
+                if else_body is not None:
+                    self.emit(depth, 'else:')
+                    self.block(else_body, names, depth + 1)
+
+            case SequenceExpression(_, expressions):
+                for e in expressions:
+                    self.discard(e, names, depth)
+
+            case LockExpression(_, _, body):
+                self.discard(body, names, depth)
+
+            case LocalExpression(_, assignments, body):
+                names = names | {assignment.var.name: self.fresh() for assignment in assignments}
+                for assignment in assignments:
+                    self.discard(assignment, names, depth)
+                self.discard(body, names, depth)
+
+            case AssignExpression():
+                self.value(expr, names, depth)
+
+            case _:
+                # evaluated for the errors it may raise, like an index out of range
+                self.emit(depth, self.value(expr, names, depth)[0])
+
+    def block(self, expr, names, depth):
+        n = len(self.lines)
+        self.discard(expr, names, depth)
+        if len(self.lines) == n:
+            self.emit(depth, 'pass')
+
+
+def native_function(lmbd: LambdaExpression):
+    """
+    Numeric leaf lambdas only do arithmetic, comparisons, indexing and control flow
+    on their own bindings. Those with a loop are worth compiling to machine code,
+    for the others the call overhead of numba outweighs what it saves.
+    """
+    if numba is None or lmbd.rest_arg or len(set(lmbd.arg_names)) < len(lmbd.arg_names) \
+            or not contains_loop(lmbd.body):
+        return None
+
+    gen = SourceGen()
+    names = {name: gen.fresh() for name in lmbd.arg_names}
+    # the types of the arguments are only known when numba compiles for a call
+    gen.kinds = dict.fromkeys(names.values())
+    try:
+        result, _ = gen.value(lmbd.body, names, 1)
+    except NotNumeric:
+        return None
+
+    return NativeFunction('\n'.join([
+        # the options are part of the source so code cached with other options is not reused
+        f'# numba.njit(**{jit_options})',
+        f'def f({", ".join(names[name] for name in lmbd.arg_names)}):',
+        *gen.lines,
+        f'    return {result}',
+        '',
+    ]))
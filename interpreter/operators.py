@@ -0,0 +1,58 @@
+import operator
+
+
+def index(container, key):
+    if type(container) != dict:
+        key = int(key)
+    return container[key]
+
+
+# the logical operators return one of their operands like Python's and/or,
+# which the bitwise functions of the operator module would not
+def logical_and(val0, val1):
+    return val0 and val1
+
+
+def logical_or(val0, val1):
+    return val0 or val1
+
+
+def nand(val0, val1):
+    return not (val0 and val1)
+
+
+def nor(val0, val1):
+    return not (val0 or val1)
+
+
+def imp(val0, val1):
+    return not val0 or val1
+
+
+unary_operators = {
+    '+': operator.pos,
+    '-': operator.neg,
+    'NOT': operator.not_,
+}
+
+binary_operators = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    'EQ': operator.eq,
+    'NEQ': operator.ne,
+    'XOR': operator.ne,
+    'AND': logical_and,
+    'OR': logical_or,
+    'NAND': nand,
+    'NOR': nor,
+    'IMP': imp,
+    '[]': index,
+}
@@ -0,0 +1,133 @@
+import math
+import unittest
+from unittest import mock
+
+from environment import Environment, new_frame
+from interpreter import interpreter
+from parser.parser import parse_expr
+
+
+def run(text):
+    interpreter.dbg = interpreter.Debugger()
+    env = interpreter.define_built_ins(Environment().push())
+    return interpreter.run(interpreter.compile(parse_expr(text)), new_frame(), env)
+
+
+class LocalTest(unittest.TestCase):
+    def test_bindings_see_earlier_ones(self):
+        self.assertEqual(run('local a = 1, b = a + 1 in b'), 2.0)
+
+    def test_inner_binding_shadows_outer_one(self):
+        self.assertEqual(run('local x = 1 in { local x = 5 in x; x }'), 1.0)
+        # the initializer already refers to the new binding, which is not assigned yet
+        with self.assertRaises(TypeError):
+            run('local a = 1, b = 2 in local a = a + b in a')
+
+    def test_global_assignment(self):
+        self.assertEqual(run('{ g = 3; g = g + 1; g }'), 4.0)
+        self.assertEqual(run(r'{ g = 2; local f = \ -> g = g * 5 in f(); g }'), 10.0)
+
+
+class ClosureTest(unittest.TestCase):
+    def test_outer_slots(self):
+        self.assertEqual(run(r'local mk = \x -> local y = x * 2 in \z -> y + z in mk(3)(4)'), 10.0)
+        self.assertEqual(run(r'local h = \a, b -> \c -> \d -> a + b + c + d in h(1, 2)(3)(4)'), 10.0)
+        self.assertEqual(run(r'local a = 1 in local f = \ -> a = a + 10 in { f(); f(); a }'), 21.0)
+
+    def test_each_call_gets_its_own_frame(self):
+        result = run(r'local mkc = \ -> local c = 0 in \ -> c = c + 1 in '
+                     r'local c1 = mkc(), c2 = mkc() in { c1(); c1(); c2(); [c1(), c2()] }')
+        self.assertEqual(result.tolist(), [3, 2])
+
+    def test_constant_arguments(self):
+        self.assertEqual(run(r'local f = \a, b, c -> a * 100 + b * 10 + c in f(1, 2, 3)'), 123.0)
+        self.assertEqual(run(r'local f = \a, s -> [a, s] in f(TRUE, "s")').tolist(), ['True', 's'])
+        self.assertIsNone(run(r'local f = \a, b -> b in f(1)'))
+
+    def test_closures_compare_by_identity(self):
+        self.assertIs(run(r'local mk = \x -> \ -> x in mk(1) == mk(1)'), False)
+        self.assertIs(run(r'local mk = \x -> \ -> x in local g = mk(1) in g == g'), True)
+
+    def test_closures_over_arrays_compare_by_identity(self):
+        self.assertIs(run(r'local mk = \x -> \ -> x in mk([1, 2]) == mk([1, 2])'), False)
+
+    def test_recursive_closures_compare_by_identity(self):
+        self.assertIs(run(r'local mk = \ -> local g = \ -> g in g in mk() == mk()'), False)
+
+    def test_rest_arguments_are_an_array(self):
+        self.assertEqual(run(r'local f = \a, r... -> r * 2 in f(1, 2, 3)').tolist(), [4, 6])
+        self.assertEqual(len(run(r'local f = \a, r... -> r in f(1)')), 0)
+
+
+class StructTest(unittest.TestCase):
+    def test_extend(self):
+        result = run('local p = struct { .x = 1; .y = 2 } in '
+                     'local q = extend p { .x = 10; .z = 3 } in [q.x, q..x, q.y, q.z]')
+        self.assertEqual(result.tolist(), [10, 1, 2, 3])
+        result = run(r'local q = extend struct { .x = 1; .y = 2 } { .x = 3; .s = \ -> ..x + .x + .y } in q.s()')
+        self.assertEqual(result, 6.0)
+
+    def test_member_assignment(self):
+        self.assertEqual(run(r'local p = struct { .x = 1; .put = \v -> .x = v } in { p.put(4); p.x }'), 4.0)
+        self.assertEqual(run('local k = struct { .n = 0; set .v = 5 } in { k.set_v(8); k.v }'), 8.0)
+
+    def test_member_access_on_different_shapes(self):
+        # one access site sees structs of several shapes, which its inline cache must tell apart
+        result = run(r'local get = \s -> s.x in [get(struct { .x = 1 }), get(struct { .y = 0; .x = 2 }), '
+                     r'get(extend struct { .x = 3 } { .z = 4 }), get(struct { .x = 5 })]')
+        self.assertEqual(result.tolist(), [1, 2, 3, 5])
+
+    def test_unknown_member_fails_before_its_value(self):
+        with mock.patch('builtins.print') as print_mock, self.assertRaises(KeyError):
+            run(r'local s = struct { .x = 1 } in local t = extend s { .f = \ -> .x = print(9) } in t.f()')
+        print_mock.assert_not_called()
+
+    def test_empty_structs_are_distinct(self):
+        self.assertIs(run('struct {} == struct {}'), False)
+
+
+class ConstantFoldingTest(unittest.TestCase):
+    def test_division_by_zero_is_not_folded(self):
+        self.assertEqual(run(r'local f = \ -> 1 / 0 in 5'), 5.0)
+        with self.assertRaises(ZeroDivisionError):
+            run('1 / 0')
+
+    def test_folded_arithmetic(self):
+        self.assertEqual(run('2 * 3 + 1'), 7.0)
+
+
+class LoopTest(unittest.TestCase):
+    def test_counts_of_zero_and_below(self):
+        self.assertEqual(run('local s = 0 in [loop 0 do s = s + 1, loop -2 do s = s + 1, s]').tolist(), [None, None, 0])
+
+    def test_fractional_count(self):
+        self.assertEqual(run('local s = 0 in { loop 2.7 do s = s + 1; s }'), 2.0)
+
+
+class ProcedureTest(unittest.TestCase):
+    def test_locals_and_globals(self):
+        self.assertEqual(run('{ g = 10; local p = proc(x) y -> { y = x + g; y } in p(5) }'), 15.0)
+        self.assertEqual(run('{ g = 1; local put = proc(v) -> g = v in put(7); g }'), 7.0)
+        self.assertEqual(run('local p = proc(a, b) -> a * b in p(3, 4)'), 12.0)
+
+
+class PurityTest(unittest.TestCase):
+    def test_memoized_arguments_keep_their_type(self):
+        self.assertEqual(run(r'local f = \x -> [x] in { f(1); f(TRUE) }').dtype, bool)
+        self.assertEqual(math.copysign(1, run(r'local f = \x -> x in { f(0); f(-0) }')), -1)
+
+    def test_sibling_lambda_read_before_assignment(self):
+        self.assertIsInstance(run(r'local f = \x -> g, h = f(1), g = \ -> 1 in { h; f(1) }'), interpreter.Closure)
+
+    def test_mutually_recursive_lambdas_are_pure(self):
+        n = 40
+        bindings = ', '.join(f'f{i} = \\x -> if x < 1 then 0 else f{(i + 1) % n}(x - 1) + f{(i + 2) % n}(x - 2)'
+                             for i in range(n))
+        self.assertIsInstance(run(f'local {bindings} in f0'), interpreter.PureClosure)
+
+    def test_calling_an_impure_lambda_is_impure(self):
+        self.assertNotIsInstance(run(r'local f = \x -> g(x), g = \x -> f(print(x)) in f'), interpreter.PureClosure)
+
+
+if __name__ == '__main__':
+    unittest.main()
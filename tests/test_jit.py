@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+
+from environment import Environment, new_frame
+from interpreter import interpreter
+from interpreter import jit
+from interpreter.jit import numba
+from parser.parser import parse_expr
+
+
+def run(text):
+    interpreter.dbg = interpreter.Debugger()
+    env = interpreter.define_built_ins(Environment().push())
+    return interpreter.run(interpreter.compile(parse_expr(text)), new_frame(), env)
+
+
+@unittest.skipIf(numba is None, 'numba is not installed')
+class NativeClosureTest(unittest.TestCase):
+    def test_loop(self):
+        self.assertEqual(run(r'local f = \n -> local s = 0, i = 0 in { loop n do { i = i + 1; s = s + i * i }; s } in f(4)'), 30.0)
+
+    def test_index_out_of_range(self):
+        with self.assertRaises(IndexError):
+            run(r'local f = \a -> { loop 1 do 0; a[10] } in f([1, 2, 3])')
+
+    def test_while_past_end(self):
+        with self.assertRaises(IndexError):
+            run(r'local f = \a -> local s = 0, i = 0 in { while i < 5 do { s = s + a[i]; i = i + 1 }; s } in f([1, 2, 3])')
+
+    def test_unsupported_arguments_fall_back(self):
+        # numba cannot take dicts, which must not keep arrays from being compiled
+        self.assertEqual(run(r'local f = \d -> { loop 1 do 0; d[1] } in { f({1: 5}); f([5, 6]) }'), 6.0)
+        self.assertEqual(run(r'local f = \d -> { loop 1 do 0; d[1] } in { f([5, 6]); f({1: 5}) }'), 5.0)
+
+    def test_bool_and_number_binding_stays_bytecode(self):
+        self.assertIs(run(r'local f = \a -> local s = 0 in { loop a do s = TRUE; s } in f(1)'), True)
+        self.assertIs(run(r'local f = \a -> { loop 1 do a = a > 0; a } in f(1)'), True)
+
+    def test_unwritable_cache_falls_back(self):
+        with mock.patch.object(jit, 'cache_dir', '/proc/incc24/jit'):
+            self.assertEqual(run(r'local f = \n -> local s = 0 in { loop n do s = s + n; s } in { f(2); f(3) }'), 9.0)
+
+
+if __name__ == '__main__':
+    unittest.main()